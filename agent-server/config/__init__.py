@@ -1,4 +1,5 @@
 """配置模块"""
+from .env import load_env_once
 from .settings import Settings, get_settings
 
-__all__ = ["Settings", "get_settings"]
+__all__ = ["Settings", "get_settings", "load_env_once"]
@@ -0,0 +1,40 @@
+"""
+环境文件加载
+"""
+import os
+from pathlib import Path
+from typing import Optional
+
+_ENV_PATHS = (
+    Path(__file__).parent.parent / ".env",
+    Path.cwd() / ".env",
+    Path.home() / ".kimi" / ".env",
+)
+
+_loaded = False
+_loaded_path: Optional[Path] = None
+
+
+def load_env_once(override: bool = False) -> Optional[Path]:
+    """从第一个存在的 .env 文件加载环境变量，只执行一次
+
+    override 为 True 时 .env 中的值覆盖已有的环境变量。
+    返回加载的文件路径，未找到时返回 None。
+    """
+    global _loaded, _loaded_path
+    if _loaded:
+        return _loaded_path
+    _loaded = True
+
+    for env_path in _ENV_PATHS:
+        if env_path.exists():
+            for line in env_path.read_text(encoding='utf-8').splitlines():
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                key, sep, value = line.partition('=')
+                if sep and (override or key not in os.environ):
+                    os.environ[key] = value
+            _loaded_path = env_path
+            break
+    return _loaded_path
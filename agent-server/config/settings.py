@@ -4,7 +4,8 @@
 import os
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Optional
+
+from .env import load_env_once
 
 
 @dataclass(frozen=True)
@@ -31,26 +32,6 @@ class Settings:
         return bool(self.kimi_api_key)
 
 
-def _load_env_file() -> None:
-    """从环境文件加载环境变量"""
-    env_paths = [
-        Path(__file__).parent.parent / ".env",
-        Path.cwd() / ".env",
-        Path.home() / ".kimi" / ".env",
-    ]
-    
-    for env_path in env_paths:
-        if env_path.exists():
-            with open(env_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#') and '=' in line:
-                        key, value = line.split('=', 1)
-                        if key not in os.environ:
-                            os.environ[key] = value
-            break
-
-
 def _ensure_kimi_base_url() -> str:
     """确保 KIMI_BASE_URL 已设置"""
     base_url = os.getenv("KIMI_BASE_URL")
@@ -62,7 +43,7 @@ def _ensure_kimi_base_url() -> str:
 
 def get_settings() -> Settings:
     """获取应用配置（单例模式）"""
-    _load_env_file()
+    load_env_once()
     
     kimi_api_key = os.getenv("KIMI_API_KEY", "")
     if kimi_api_key:
@@ -4,47 +4,51 @@
 """
 
 import os
-import sys
-import json
+import orjson
 import asyncio
+import bisect
+import functools
+import itertools
+import logging
+import threading
 from pathlib import Path
-
-# 强制立即刷新 print 输出
-sys.stdout.reconfigure(line_buffering=True)
+from collections import OrderedDict, deque
 from typing import Optional, Dict, Any, List, Callable
 from datetime import datetime
-from dataclasses import dataclass, asdict
+from secrets import token_hex
+from dataclasses import dataclass, field, replace
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import uvicorn
-
-# 加载环境变量
-env_paths = [
-    Path(__file__).parent / ".env",
-    Path.cwd() / ".env",
-    Path.home() / ".kimi" / ".env",
-]
-for env_path in env_paths:
-    if env_path.exists():
-        print(f"Loading environment from: {env_path}")
-        with open(env_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    # .env 文件优先于环境变量
-                    os.environ[key] = value
-                    print(f"  Set {key}={value[:10]}...")
-        break
-
-from kimi_agent_sdk import Session, prompt, TextPart, ApprovalRequest, ToolCall, ToolResult
-from kaos.path import KaosPath
-from kosong.message import ImageURLPart
+
+# 加载环境变量（.env 文件优先于环境变量）
+from config.env import load_env_once
+env_path = load_env_once(override=True)
+
 import base64
 
+# 日志级别可通过 AGENT_LOG_LEVEL 调整（如 DEBUG），无效值时退回 INFO
+_log_level = os.getenv("AGENT_LOG_LEVEL", "INFO").upper()
+if not isinstance(getattr(logging, _log_level, None), int):
+    _log_level = "INFO"
+logging.basicConfig(
+    level=_log_level,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger("cowork")
+if env_path:
+    log.info("Loading environment from: %s", env_path)
+
+@functools.lru_cache(maxsize=1)
+def _sdk() -> tuple:
+    """延迟导入 kimi-agent-sdk 相关模块，首次对话时才加载"""
+    from kimi_agent_sdk import Session, TextPart, ApprovalRequest, ToolCall
+    from kaos.path import KaosPath
+    from kosong.message import ImageURLPart
+    return Session, TextPart, ApprovalRequest, ToolCall, KaosPath, ImageURLPart
+
 # ============ 配置 ============
 DEFAULT_MODEL = os.getenv("KIMI_MODEL", "kimi-k2-thinking-turbo")
 KIMI_API_KEY = os.getenv("KIMI_API_KEY", "")
@@ -57,15 +61,104 @@ if not os.getenv("KIMI_BASE_URL"):
     os.environ["KIMI_BASE_URL"] = "https://api.moonshot.cn/v1"
 if not os.getenv("KIMI_MODEL_NAME"):
     os.environ["KIMI_MODEL_NAME"] = DEFAULT_MODEL
+# 默认支持图片输入
+DEFAULT_CAPABILITIES = "image_in,thinking"
 if not os.getenv("KIMI_MODEL_CAPABILITIES"):
-    # 默认支持图片输入
-    os.environ["KIMI_MODEL_CAPABILITIES"] = "image_in,thinking"
+    os.environ["KIMI_MODEL_CAPABILITIES"] = DEFAULT_CAPABILITIES
+
+# 用户自定义设置（通过 HTTP / WebSocket 更新）
+@dataclass(frozen=True, slots=True)
+class RuntimeSettings:
+    """运行时设置快照，更新时整体替换而不是原地修改"""
+    model: Optional[str] = None  # None 表示使用默认
+    api_key: Optional[str] = None  # None 表示使用环境变量
+    capabilities: str = DEFAULT_CAPABILITIES
+    
+    @property
+    def effective_model(self) -> str:
+        return self.model or DEFAULT_MODEL
+
+_runtime_settings = RuntimeSettings()
+
+def get_runtime_settings() -> RuntimeSettings:
+    """获取当前设置快照"""
+    return _runtime_settings
+
+def update_runtime_settings(model: Optional[str] = None, api_key: Optional[str] = None) -> RuntimeSettings:
+    """以新快照替换当前设置，空值表示保持不变"""
+    global _runtime_settings
+    current = _runtime_settings
+    new = replace(current, model=model or current.model, api_key=api_key or current.api_key)
+    if new != current and new.api_key:
+        # SDK 通过环境变量读取 API Key 和模型，只在设置变化时同步一次
+        # 同时设置模型名称，确保 create_llm 不会返回 None
+        os.environ.update({
+            "KIMI_API_KEY": new.api_key,
+            "KIMI_MODEL_NAME": new.effective_model,
+            "KIMI_MODEL_CAPABILITIES": new.capabilities,
+        })
+    _runtime_settings = new
+    return new
+
+# ============ 提示词与文件类型 ============
+# 附加在每次请求末尾的工具说明
+_TOOLS_DESCRIPTION = """
+你可以使用以下工具来完成任务:
+
+### 文件操作
+- 读取、写入、编辑、删除文件
+- 列出目录内容
+- 搜索文件内容
+
+### 命令执行
+- 执行 shell 命令
+- 运行脚本
+
+### Git 操作
+- git status, git add, git commit, git diff
+
+### Artifacts （重要！）
+当用户需要生成代码、图表、网页等内容时，你可以使用 artifact 标签来创建可交互的预览：
+
+1. **HTML 网页**：<artifact type="html" title="页面标题">HTML代码</artifact>
+2. **React 组件**：<artifact type="react" title="组件名称">JSX代码</artifact>
+3. **SVG 图形**：<artifact type="svg" title="图表名称">SVG代码</artifact>
+4. **Python 代码**：<artifact type="python" title="脚本名称">Python代码</artifact>
+5. **Markdown**：<artifact type="markdown" title="文档标题">Markdown内容</artifact>
+
+示例：
+```
+<artifact type="react" title="计数器组件">
+export default function Counter() {
+  const [count, setCount] = React.useState(0);
+  return (
+    <div>
+      <p>Count: {count}</p>
+      <button onClick={() => setCount(count + 1)}>+1</button>
+    </div>
+  );
+}
+</artifact>
+```
+
+用户可以在侧边栏看到并交互预览你创建的内容！
+"""
 
-# 用户自定义设置（通过 WebSocket 更新）
-user_settings = {
-    "model": None,  # None 表示使用默认
-    "api_key": None,  # None 表示使用环境变量
+# 图片扩展名 -> MIME 类型
+_IMAGE_MIME = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.bmp': 'image/bmp',
 }
+_IMAGE_EXTS = frozenset(_IMAGE_MIME)
+
+def _suffix_lower(name: str) -> str:
+    """小写扩展名（含点），只做字符串操作，不构造 Path"""
+    dot = name.rfind('.')
+    return name[dot:].lower() if dot >= 0 else ''
 
 # ============ 数据模型 ============
 class Message(BaseModel):
@@ -88,52 +181,309 @@ class TaskStatus(BaseModel):
     error: Optional[str] = None
 
 # ============ 会话管理 ============
-@dataclass
+# 会话头信息（含消息数）写入 <session_id>.meta.json，随消息一起刷新，
+# 消息以追加方式写入 <session_id>.jsonl（每行一条 JSON）
+META_SUFFIX = ".meta.json"
+MESSAGES_SUFFIX = ".jsonl"
+# 脏会话批量落盘的间隔（秒）
+FLUSH_INTERVAL = 0.25
+# 内存中保留的会话 / 任务上限，超出后淘汰最久未使用的
+MAX_LIVE_SESSIONS = 256
+MAX_ACTIVE_TASKS = 1024
+# 历史对话上下文保留的消息条数，以及 AI 回复的截断长度
+CONTEXT_MESSAGES = 10
+CONTEXT_TRUNCATE = 500
+
+def _context_line(msg: Dict[str, Any]) -> Optional[str]:
+    """将消息格式化为历史对话上下文中的一行"""
+    if msg["role"] == "user":
+        return f"用户: {msg['content']}"
+    if msg["role"] == "assistant":
+        # 截取 AI 回复的前 500 字符，避免上下文过长
+        content = msg["content"][:CONTEXT_TRUNCATE] if msg["content"] else ""
+        if len(msg["content"]) > CONTEXT_TRUNCATE:
+            content += "..."
+        return f"AI: {content}"
+    return None
+
+def _insert_capped(od: OrderedDict, key, value, cap: int):
+    """插入 OrderedDict 并淘汰超出上限的最旧条目"""
+    od[key] = value
+    od.move_to_end(key)
+    if len(od) > cap:
+        od.popitem(last=False)
+
+@dataclass(slots=True)
 class CoworkSession:
     session_id: str
     work_dir: str
     created_at: str
-    messages: List[Dict[str, Any]]
+    message_count: int = 0
+    messages: Optional[List[Dict[str, Any]]] = None  # None 表示消息尚未从磁盘加载
+    _view: Dict[str, Any] = field(init=False, repr=False, compare=False)
+    # 最近几条消息已格式化好的上下文行
+    _ctx_deque: deque = field(default_factory=lambda: deque(maxlen=CONTEXT_MESSAGES), init=False, repr=False, compare=False)
     
-    def to_dict(self):
-        return {
+    def __post_init__(self):
+        # 头信息不变，只需在 to_dict 时同步 messages 引用
+        self._view = {
             "session_id": self.session_id,
             "work_dir": self.work_dir,
             "created_at": self.created_at,
             "messages": self.messages,
         }
+    
+    def meta_dict(self):
+        return {
+            "session_id": self.session_id,
+            "work_dir": self.work_dir,
+            "created_at": self.created_at,
+            "message_count": self.message_count,
+        }
+    
+    def to_dict(self):
+        self._view["messages"] = self.messages
+        return self._view
 
 class SessionManager:
     """Cowork 会话管理器"""
     
     def __init__(self):
-        self.sessions: Dict[str, CoworkSession] = {}
-        self.active_tasks: Dict[str, TaskStatus] = {}
+        # 被淘汰的会话仍保留在磁盘上，访问时重新加载
+        self.sessions: OrderedDict[str, CoworkSession] = OrderedDict()
+        self.active_tasks: OrderedDict[str, TaskStatus] = OrderedDict()
         self.sessions_dir = Path.home() / ".kimi" / "cowork-desktop" / "sessions"
         self.sessions_dir.mkdir(parents=True, exist_ok=True)
+        # 尚未落盘的新消息及其会话，以及等待刷新的会话 ID 队列
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        self._dirty_sessions: Dict[str, CoworkSession] = {}
+        self._dirty: asyncio.Queue = asyncio.Queue()
+        # 正在线程池中执行的写入，以及该批次涉及的会话（写完前磁盘内容已过期）
+        self._write_future: Optional[asyncio.Future] = None
+        self._inflight: Dict[str, CoworkSession] = {}
+        # 写入期间被删除的会话；与删除文件的操作通过 _write_lock 互斥
+        self._deleted: set = set()
+        self._write_lock = threading.Lock()
+        # 磁盘上所有会话的 ID，按创建顺序排列（ID 由创建时间生成，字典序即时间序）
+        self._session_ids: List[str] = []
         self.load_sessions()
     
+    def _meta_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}{META_SUFFIX}"
+    
+    def _messages_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}{MESSAGES_SUFFIX}"
+    
     def load_sessions(self):
-        """加载保存的会话"""
-        for session_file in self.sessions_dir.glob("*.json"):
+        """加载保存的会话（只读取头信息，消息在首次访问时加载）"""
+        # 按文件名（即创建时间）排序，超出上限时保留最新的会话
+        with os.scandir(self.sessions_dir) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            if not (entry.name.endswith('.json') and entry.is_file(follow_symlinks=False)):
+                continue
             try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    session = CoworkSession(
-                        session_id=data["session_id"],
-                        work_dir=data["work_dir"],
-                        created_at=data["created_at"],
-                        messages=data.get("messages", [])
-                    )
-                    self.sessions[session.session_id] = session
+                if entry.name.endswith(META_SUFFIX):
+                    session = self._read_meta(entry.path)
+                else:
+                    session = self._migrate_legacy(entry.path)
+                _insert_capped(self.sessions, session.session_id, session, MAX_LIVE_SESSIONS)
+                self._session_ids.append(session.session_id)
             except Exception as e:
-                print(f"加载会话失败 {session_file}: {e}")
+                log.warning("加载会话失败 %s: %s", entry.path, e)
+        # 迁移中断时旧文件和新头信息可能同时存在，同一会话只保留一次
+        self._session_ids = sorted(set(self._session_ids))
+    
+    def _read_meta(self, path) -> CoworkSession:
+        """读取会话头信息（不含消息）"""
+        with open(path, 'rb') as f:
+            data = orjson.loads(f.read())
+        message_count = data.get("message_count")
+        if message_count is None:
+            # 早期的头信息没有记录消息数，统计一次 jsonl 行数，下次刷新时写回
+            message_count = self._count_messages(data["session_id"])
+        return CoworkSession(
+            session_id=data["session_id"],
+            work_dir=data["work_dir"],
+            created_at=data["created_at"],
+            message_count=message_count,
+        )
+    
+    def _count_messages(self, session_id: str) -> int:
+        """统计 jsonl 中可读取的消息数"""
+        return len(self._read_messages(session_id))
+    
+    def _migrate_legacy(self, path: str) -> CoworkSession:
+        """将旧版单文件 <session_id>.json 转换为 meta + jsonl 格式"""
+        with open(path, 'rb') as f:
+            data = orjson.loads(f.read())
+        session = CoworkSession(
+            session_id=data["session_id"],
+            work_dir=data["work_dir"],
+            created_at=data["created_at"],
+            messages=data.get("messages", [])
+        )
+        session.message_count = len(session.messages)
+        self._rebuild_context(session)
+        # 整体写入而不是追加：若在删除旧文件前中断，下次重新迁移不会产生重复消息
+        self._write_messages(session.session_id, session.messages)
+        self._write_meta(session)
+        os.unlink(path)
+        return session
     
-    def save_session(self, session: CoworkSession):
-        """保存会话"""
-        session_file = self.sessions_dir / f"{session.session_id}.json"
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(session.to_dict(), f, ensure_ascii=False, indent=2)
+    def _write_meta(self, session: CoworkSession):
+        """写入会话头信息"""
+        self._write_meta_dict(session.meta_dict())
+    
+    def _write_meta_dict(self, meta: Dict[str, Any]):
+        # 先写临时文件再替换，避免写入中断导致头信息损坏
+        path = self._meta_path(meta["session_id"])
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, path)
+    
+    def _write_messages(self, session_id: str, messages: List[Dict[str, Any]]):
+        """先写临时文件再替换，整体写入全部消息"""
+        path = self._messages_path(session_id)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            for msg in messages:
+                f.write(orjson.dumps(msg, option=orjson.OPT_APPEND_NEWLINE))
+        os.replace(tmp_path, path)
+    
+    def _append_messages(self, session_id: str, messages: List[Dict[str, Any]]):
+        """以追加方式写入消息，失败时截掉本次写入的部分"""
+        with open(self._messages_path(session_id), 'ab') as f:
+            start = f.tell()
+            try:
+                for msg in messages:
+                    f.write(orjson.dumps(msg, option=orjson.OPT_APPEND_NEWLINE))
+                f.flush()
+            except Exception:
+                f.truncate(start)
+                raise
+    
+    def _read_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        """读取 jsonl 中的消息，跳过无法解析的行"""
+        path = self._messages_path(session_id)
+        messages = []
+        offset = 0
+        truncate_at = None
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            messages.append(orjson.loads(line))
+                        except orjson.JSONDecodeError:
+                            if line.endswith(b"\n"):
+                                log.warning("跳过无法解析的消息 %s 第 %d 条", session_id, len(messages) + 1)
+                            else:
+                                # 没有换行的末行是写入中断留下的，截掉以免之后追加的消息接在它后面
+                                truncate_at = offset
+                    offset += len(line)
+        except FileNotFoundError:
+            return []
+        if truncate_at is not None:
+            log.warning("截掉写入不完整的末行 %s", session_id)
+            with self._write_lock:
+                os.truncate(path, truncate_at)
+        return messages
+    
+    def _ensure_messages_loaded(self, session: CoworkSession):
+        """首次访问时从 jsonl 文件读取会话消息"""
+        if session.messages is not None:
+            return
+        messages = self._read_messages(session.session_id)
+        # 尚未落盘的消息已经在内存中，追加到末尾
+        messages.extend(self._pending.get(session.session_id, []))
+        session.messages = messages
+        self._rebuild_context(session)
+    
+    def _rebuild_context(self, session: CoworkSession):
+        """根据最近的消息重建历史对话上下文"""
+        session._ctx_deque.clear()
+        for msg in session.messages[-CONTEXT_MESSAGES:]:
+            line = _context_line(msg)
+            if line is not None:
+                session._ctx_deque.append(line)
+    
+    def _mark_dirty(self, session_id: str):
+        """标记会话需要落盘，由后台任务批量刷新"""
+        self._dirty.put_nowait(session_id)
+    
+    def _take_pending(self) -> Dict[str, tuple]:
+        """取出当前所有待落盘的消息及对应的头信息快照"""
+        while not self._dirty.empty():
+            self._dirty.get_nowait()
+        pending, self._pending = self._pending, {}
+        dirty_sessions, self._dirty_sessions = self._dirty_sessions, {}
+        self._inflight = dirty_sessions
+        return {
+            session_id: (dirty_sessions[session_id].meta_dict(), messages)
+            for session_id, messages in pending.items()
+        }
+    
+    def _write_batch(self, batch: Dict[str, tuple]) -> Dict[str, List[Dict[str, Any]]]:
+        """写入一批会话，返回写入失败的会话及其尚未落盘的消息"""
+        failed = {}
+        for session_id, (meta, messages) in batch.items():
+            with self._write_lock:
+                # 会话已被删除，跳过以免重新创建文件
+                if session_id in self._deleted:
+                    continue
+                try:
+                    self._append_messages(session_id, messages)
+                except Exception as e:
+                    # 消息未写入，也不更新头信息，保持消息数与 jsonl 一致
+                    log.warning("保存会话失败 %s: %s", session_id, e)
+                    failed[session_id] = messages
+                    continue
+                try:
+                    self._write_meta_dict(meta)
+                except Exception as e:
+                    # 消息已写入，只需下次重写头信息
+                    log.warning("保存会话失败 %s: %s", session_id, e)
+                    failed[session_id] = []
+        return failed
+    
+    async def flush_loop(self):
+        """后台任务：每 FLUSH_INTERVAL 秒批量写入脏会话"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._dirty.get()
+            await asyncio.sleep(FLUSH_INTERVAL)
+            batch = self._take_pending()
+            if batch:
+                self._write_future = loop.run_in_executor(None, self._write_batch, batch)
+                self._write_future.add_done_callback(self._write_done)
+                # 任务被取消时线程中的写入仍会继续，shield 保证 drain 可以等待它完成
+                await asyncio.shield(self._write_future)
+    
+    def _write_done(self, future: asyncio.Future):
+        self._finish_write(future.result())
+    
+    def _finish_write(self, failed: Dict[str, List[Dict[str, Any]]]):
+        """批次写入完成，磁盘内容重新成为最新；写入失败的消息放回队首等待下次刷新"""
+        for session_id, messages in failed.items():
+            session = self._inflight.get(session_id)
+            if session is None or session_id in self._deleted:
+                continue
+            self._pending[session_id] = messages + self._pending.get(session_id, [])
+            self._dirty_sessions[session_id] = session
+            self._mark_dirty(session_id)
+        self._inflight = {}
+        self._deleted.clear()
+    
+    async def drain(self):
+        """等待正在线程池中执行的写入完成"""
+        if self._write_future is not None and not self._write_future.done():
+            await asyncio.wait([self._write_future])
+    
+    def flush(self):
+        """同步写入所有待落盘的消息（关闭时调用，调用前需先 drain）"""
+        self._finish_write(self._write_batch(self._take_pending()))
     
     def create_session(self, work_dir: str) -> CoworkSession:
         """创建新会话"""
@@ -144,34 +494,99 @@ class SessionManager:
             created_at=datetime.now().isoformat(),
             messages=[]
         )
-        self.sessions[session_id] = session
-        self.save_session(session)
+        _insert_capped(self.sessions, session_id, session, MAX_LIVE_SESSIONS)
+        bisect.insort(self._session_ids, session_id)
+        self._write_meta(session)
+        return session
+    
+    def _lookup(self, session_id: str) -> Optional[CoworkSession]:
+        """查找会话头信息，已被淘汰的会话从磁盘重新加载"""
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+        # 已被淘汰但仍有未落盘或正在写入的消息时，磁盘上的内容已过期，
+        # 直接复用内存中的会话（其消息已全部加载）
+        session = self._dirty_sessions.get(session_id) or self._inflight.get(session_id)
+        if session is None:
+            if os.sep in session_id or (os.altsep and os.altsep in session_id):
+                return None
+            try:
+                session = self._read_meta(self._meta_path(session_id))
+            except (OSError, ValueError):
+                # 文件不存在，或客户端传入的 id 不是合法文件名（含 NUL、过长等）
+                return None
+        _insert_capped(self.sessions, session_id, session, MAX_LIVE_SESSIONS)
         return session
     
     def get_session(self, session_id: str) -> Optional[CoworkSession]:
-        """获取会话"""
-        return self.sessions.get(session_id)
+        """获取会话（按需加载消息）"""
+        session = self._lookup(session_id)
+        if session is not None:
+            self._ensure_messages_loaded(session)
+        return session
+    
+    def delete_session(self, session_id: str) -> bool:
+        """删除会话及其文件"""
+        if self._lookup(session_id) is None:
+            return False
+        del self.sessions[session_id]
+        self._pending.pop(session_id, None)
+        self._dirty_sessions.pop(session_id, None)
+        if self._inflight.pop(session_id, None) is not None:
+            self._deleted.add(session_id)
+        i = bisect.bisect_left(self._session_ids, session_id)
+        if i < len(self._session_ids) and self._session_ids[i] == session_id:
+            del self._session_ids[i]
+        # 持锁删除：正在写入该会话的线程写完后才删除，之后的写入会跳过它
+        with self._write_lock:
+            for path in (self._meta_path(session_id), self._messages_path(session_id)):
+                path.unlink(missing_ok=True)
+        return True
     
-    def list_sessions(self) -> List[CoworkSession]:
-        """列出所有会话"""
-        return sorted(self.sessions.values(), key=lambda s: s.created_at, reverse=True)
+    def list_sessions(self, limit: int = 20) -> List[CoworkSession]:
+        """按创建时间倒序列出最近的会话"""
+        sessions = (self._lookup(session_id) for session_id in reversed(self._session_ids))
+        return list(itertools.islice((s for s in sessions if s is not None), limit))
     
     def add_message(self, session_id: str, role: str, content: str, tools_used: Optional[List[Dict]] = None):
         """添加消息到会话"""
-        if session_id in self.sessions:
-            self.sessions[session_id].messages.append({
+        session = self.get_session(session_id)
+        if session is not None:
+            msg = {
                 "role": role,
                 "content": content,
                 "timestamp": datetime.now().isoformat(),
                 "tools_used": tools_used or []
-            })
-            self.save_session(self.sessions[session_id])
+            }
+            session.messages.append(msg)
+            session.message_count += 1
+            line = _context_line(msg)
+            if line is not None:
+                session._ctx_deque.append(line)
+            self._pending.setdefault(session_id, []).append(msg)
+            self._dirty_sessions[session_id] = session
+            self._mark_dirty(session_id)
 
 # 全局会话管理器
 session_manager = SessionManager()
 
 # ============ FastAPI 应用 ============
-app = FastAPI(title="Kimi Cowork Agent Server")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flush_task = asyncio.create_task(session_manager.flush_loop())
+    try:
+        yield
+    finally:
+        flush_task.cancel()
+        try:
+            await flush_task
+        except asyncio.CancelledError:
+            pass
+        # 先等线程中的写入结束，避免与最后一次刷新同时追加同一个文件
+        await session_manager.drain()
+        session_manager.flush()
+
+app = FastAPI(title="Kimi Cowork Agent Server", lifespan=lifespan)
 
 # CORS 中间件
 app.add_middleware(
@@ -199,21 +614,16 @@ class SettingsRequest(BaseModel):
 @app.post("/settings")
 async def update_settings(request: SettingsRequest):
     """更新用户设置"""
-    global user_settings
-    if request.model:
-        user_settings["model"] = request.model
-    if request.api_key:
-        user_settings["api_key"] = request.api_key
-        # 更新环境变量
-        os.environ["KIMI_API_KEY"] = request.api_key
-    return {"status": "ok", "settings": user_settings}
+    rs = update_runtime_settings(model=request.model, api_key=request.api_key)
+    return {"status": "ok", "settings": {"model": rs.model, "api_key": rs.api_key}}
 
 @app.get("/settings")
 async def get_settings():
     """获取当前设置"""
+    rs = get_runtime_settings()
     return {
-        "model": user_settings["model"] or DEFAULT_MODEL,
-        "api_key": "***" if user_settings["api_key"] else None
+        "model": rs.effective_model,
+        "api_key": "***" if rs.api_key else None
     }
 
 @app.post("/task")
@@ -222,16 +632,15 @@ async def create_task(request: TaskRequest):
     task_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
     
     # 创建或恢复会话
-    if request.session_id and request.session_id in session_manager.sessions:
-        session = session_manager.sessions[request.session_id]
-    else:
+    session = session_manager.get_session(request.session_id) if request.session_id else None
+    if session is None:
         session = session_manager.create_session(request.work_dir)
     
     task_status = TaskStatus(
         task_id=task_id,
         status="pending"
     )
-    session_manager.active_tasks[task_id] = task_status
+    _insert_capped(session_manager.active_tasks, task_id, task_status, MAX_ACTIVE_TASKS)
     
     return {
         "task_id": task_id,
@@ -242,16 +651,16 @@ async def create_task(request: TaskRequest):
 @app.get("/sessions")
 async def list_sessions():
     """列出所有会话"""
-    sessions = session_manager.list_sessions()
+    sessions = session_manager.list_sessions(20)
     return {
         "sessions": [
             {
                 "session_id": s.session_id,
                 "work_dir": s.work_dir,
                 "created_at": s.created_at,
-                "message_count": len(s.messages)
+                "message_count": s.message_count
             }
-            for s in sessions[:20]
+            for s in sessions
         ]
     }
 
@@ -266,16 +675,16 @@ async def get_session(session_id: str):
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
     """删除会话"""
-    if session_id in session_manager.sessions:
-        del session_manager.sessions[session_id]
-        session_file = session_manager.sessions_dir / f"{session_id}.json"
-        if session_file.exists():
-            session_file.unlink()
+    if session_manager.delete_session(session_id):
         return {"status": "deleted"}
     return {"error": "Session not found"}, 404
 
 # ============ WebSocket 路由 ============
 
+def send_json(websocket: WebSocket, message: Dict):
+    """使用 orjson 编码并以文本帧发送"""
+    return websocket.send_text(orjson.dumps(message).decode())
+
 class ConnectionManager:
     """WebSocket 连接管理器"""
     
@@ -292,7 +701,7 @@ class ConnectionManager:
     
     async def send_message(self, client_id: str, message: Dict):
         if client_id in self.active_connections:
-            await self.active_connections[client_id].send_json(message)
+            await send_json(self.active_connections[client_id], message)
 
 manager = ConnectionManager()
 
@@ -308,40 +717,231 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 await handle_chat(websocket, data)
             elif data.get("type") == "settings":
                 # 更新设置
-                global user_settings
                 settings = data.get("settings", {})
-                print(f"[DEBUG] Received settings update: model={settings.get('model')}, api_key={'***' if settings.get('api_key') else 'none'}")
-                if settings.get("model"):
-                    user_settings["model"] = settings["model"]
+                log.debug("Received settings update: model=%s, api_key=%s", settings.get('model'), '***' if settings.get('api_key') else 'none')
+                rs = update_runtime_settings(model=settings.get("model"), api_key=settings.get("api_key"))
                 if settings.get("api_key"):
-                    user_settings["api_key"] = settings["api_key"]
-                    os.environ["KIMI_API_KEY"] = settings["api_key"]
-                    # 同时设置模型名称，确保 create_llm 不会返回 None
-                    model_name = settings.get("model") or user_settings.get("model") or DEFAULT_MODEL
-                    user_settings["model"] = model_name  # 确保 user_settings 中也有 model
-                    os.environ["KIMI_MODEL_NAME"] = model_name
-                    # 设置模型能力（kimi-k2.5 支持图片输入）
-                    os.environ["KIMI_MODEL_CAPABILITIES"] = "image_in,thinking"
-                    print(f"[DEBUG] API Key updated: {settings['api_key'][:10]}... (len={len(settings['api_key'])})")
-                    print(f"[DEBUG] Model name set to: {model_name}")
-                    print(f"[DEBUG] Capabilities set to: image_in,thinking")
-                    print(f"[DEBUG] user_settings after update: {user_settings}")
-                await websocket.send_json({
+                    log.debug("API Key updated: %.10s... (len=%d)", settings['api_key'], len(settings['api_key']))
+                    log.debug("Model name set to: %s", rs.effective_model)
+                    log.debug("Capabilities set to: %s", rs.capabilities)
+                await send_json(websocket, {
                     "type": "settings_updated",
                     "status": "ok"
                 })
             elif data.get("type") == "abort":
                 # 处理中断请求
-                await websocket.send_json({
+                await send_json(websocket, {
                     "type": "aborted",
                     "message": "任务已中断"
                 })
     except WebSocketDisconnect:
         manager.disconnect(client_id)
     except Exception as e:
-        print(f"WebSocket 错误: {e}")
+        log.warning("WebSocket 错误: %s", e)
         manager.disconnect(client_id)
 
+# 选中文件的大小限制
+MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_TEXT_FILE_SIZE = 100 * 1024  # 100KB
+
+@dataclass
+class SelectedFileData:
+    """在线程中读取的选中文件信息"""
+    exists: bool
+    is_file: bool = False
+    size: int = 0
+    content: Optional[str] = None  # 文本内容或图片 data URL；None 表示超出大小限制
+
+def _file_to_data_url(path: Path, mime_type: str) -> str:
+    """分块读取文件并编码为 base64 data URL，避免整份数据的中间副本"""
+    out = bytearray(b'data:')
+    out += mime_type.encode()
+    out += b';base64,'
+    with open(path, 'rb') as f:
+        # 57KB 是 3 的倍数，分块编码不会在中间产生填充
+        while chunk := f.read(57 * 1024):
+            out += base64.b64encode(chunk)
+    return out.decode('ascii')
+
+def _read_selected_file(path: Path, mime_type: Optional[str] = None) -> SelectedFileData:
+    """读取选中的文件（阻塞 I/O，需通过 asyncio.to_thread 调用）
+
+    mime_type 不为空时按图片处理，返回 data URL；否则按文本读取。
+    """
+    if not path.exists():
+        return SelectedFileData(exists=False)
+    if not path.is_file():
+        return SelectedFileData(exists=True)
+    
+    size = path.stat().st_size
+    data = SelectedFileData(exists=True, is_file=True, size=size)
+    if mime_type:
+        if size < MAX_IMAGE_SIZE:
+            data.content = _file_to_data_url(path, mime_type)
+    elif size < MAX_TEXT_FILE_SIZE:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                data.content = f.read()
+        except Exception as e:
+            data.content = f"[无法读取文件内容: {e}]"
+    return data
+
+# 会修改文件的工具，调用后通知前端刷新
+_FILE_MODIFYING_TOOLS = frozenset(['write_file', 'edit_file', 'str_replace', 'str_replace_editor'])
+# 合并文本片段的时间窗口（秒），窗口内到达的片段合并为一帧发送
+STREAM_FLUSH_DELAY = 0.008
+
+@dataclass
+class ChatStream:
+    """一次对话流式输出过程中的状态"""
+    websocket: WebSocket
+    session_id: str
+    auto_accept: bool
+    chunks: List[str] = field(default_factory=list)
+    tools_used: List[Dict[str, Any]] = field(default_factory=list)
+    # 尚未发送的文本片段和定时发送任务
+    pending_text: List[str] = field(default_factory=list)
+    flush_task: Optional[asyncio.Task] = None
+    send_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # 定时发送失败时记录的异常，由下一次处理文本或 flush_text 时抛出
+    send_error: Optional[Exception] = None
+
+async def _send_pending_text(stream: ChatStream):
+    """发送缓冲的文本片段（调用方需持有 send_lock）"""
+    if not stream.pending_text:
+        return
+    content = "".join(stream.pending_text)
+    stream.pending_text.clear()
+    await send_json(stream.websocket, {
+        "type": "stream",
+        "content": content,
+        "session_id": stream.session_id
+    })
+
+async def _flush_text_later(stream: ChatStream):
+    await asyncio.sleep(STREAM_FLUSH_DELAY)
+    stream.flush_task = None
+    async with stream.send_lock:
+        try:
+            await _send_pending_text(stream)
+        except Exception as e:
+            # 后台任务无人等待，保存异常交给对话主流程处理（如客户端已断开）
+            stream.send_error = e
+
+def _raise_send_error(stream: ChatStream):
+    if stream.send_error is not None:
+        raise stream.send_error
+
+async def flush_text(stream: ChatStream):
+    """立即发送缓冲的文本，发送其他消息前调用以保持顺序"""
+    if stream.flush_task is not None:
+        stream.flush_task.cancel()
+        stream.flush_task = None
+    # 即使没有缓冲文本也要获取锁，等待正在进行的定时发送完成
+    async with stream.send_lock:
+        _raise_send_error(stream)
+        await _send_pending_text(stream)
+
+def cancel_text_flush(stream: ChatStream):
+    """取消定时发送并丢弃缓冲的文本（对话出错时调用）"""
+    if stream.flush_task is not None:
+        stream.flush_task.cancel()
+        stream.flush_task = None
+    stream.pending_text.clear()
+
+async def _handle_text(wire_msg, stream: ChatStream):
+    _raise_send_error(stream)
+    text = wire_msg.text
+    if text:
+        # 调试：打印每个文本片段
+        log.debug("TextPart: %.100r...", text)
+        stream.chunks.append(text)
+        stream.pending_text.append(text)
+        if stream.flush_task is None:
+            stream.flush_task = asyncio.create_task(_flush_text_later(stream))
+
+async def _handle_tool_call(wire_msg, stream: ChatStream):
+    await flush_text(stream)
+    func = getattr(wire_msg, 'function', None)
+    if isinstance(func, dict):
+        tool_name = func.get('name') or 'unknown'
+        tool_args_raw = func.get('arguments', '{}')
+    elif func is not None:
+        tool_name = getattr(func, 'name', None) or 'unknown'
+        tool_args_raw = getattr(func, 'arguments', None) or '{}'
+    else:
+        tool_name = 'unknown'
+        tool_args_raw = {}
+
+    # 解析 arguments
+    if isinstance(tool_args_raw, str):
+        try:
+            tool_args = orjson.loads(tool_args_raw)
+        except orjson.JSONDecodeError:
+            tool_args = {"raw": tool_args_raw}
+    else:
+        tool_args = tool_args_raw
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Tool call: %s with args: %s", tool_name, tool_args)
+
+    stream.tools_used.append({"tool": tool_name, "args": tool_args})
+    await send_json(stream.websocket, {
+        "type": "tool_call",
+        "tool": tool_name,
+        "args": tool_args,
+        "session_id": stream.session_id
+    })
+
+    # 检测文件修改操作，通知前端更新
+    if tool_name in _FILE_MODIFYING_TOOLS:
+        # 提取文件路径
+        file_path = tool_args.get('path') or tool_args.get('file_path') or tool_args.get('file')
+        if file_path:
+            await send_json(stream.websocket, {
+                "type": "file_modified",
+                "file_path": file_path,
+                "tool": tool_name,
+                "session_id": stream.session_id
+            })
+
+async def _handle_approval(wire_msg, stream: ChatStream):
+    await flush_text(stream)
+    if stream.auto_accept:
+        wire_msg.resolve("approve")
+        await send_json(stream.websocket, {
+            "type": "tool_approved",
+            "auto": True
+        })
+    else:
+        # 发送批准请求给前端
+        await send_json(stream.websocket, {
+            "type": "approval_request",
+            "message": "需要您的批准才能继续"
+        })
+        # 等待前端响应（简化处理，实际应该异步等待）
+        wire_msg.resolve("approve")
+
+@functools.lru_cache(maxsize=1)
+def _dispatch_table() -> Dict[type, Optional[Callable]]:
+    """消息类型 -> 处理函数，按 type() 精确查找，避免逐个 isinstance（退回查找的结果也记在表中）"""
+    _, TextPart, ApprovalRequest, ToolCall, _, _ = _sdk()
+    return {
+        TextPart: _handle_text,
+        ToolCall: _handle_tool_call,
+        ApprovalRequest: _handle_approval,
+    }
+
+# 分发表中尚未查找过的类型
+_UNKNOWN_TYPE = object()
+
+def _find_handler(dispatch: Dict[type, Optional[Callable]], wire_msg) -> Optional[Callable]:
+    """精确类型未命中时（如子类），退回 isinstance 判断"""
+    for cls, handler in dispatch.items():
+        if handler is not None and isinstance(wire_msg, cls):
+            return handler
+    return None
+
 async def handle_chat(websocket: WebSocket, data: Dict):
     """处理聊天消息"""
     message = data.get("message", "")
@@ -351,39 +951,30 @@ async def handle_chat(websocket: WebSocket, data: Dict):
     selected_file = data.get("selected_file")  # 获取选中的文件信息
     
     # 调试日志
-    print(f"[DEBUG] Received message: {message[:50]}...")
-    print(f"[DEBUG] Selected file: {selected_file}")
+    log.debug("Received message: %.50s...", message)
+    log.debug("Selected file: %s", selected_file)
     
+    stream: Optional[ChatStream] = None
     try:
+        # SDK 在首次对话时才导入，放在 try 内，导入失败时客户端也能收到 error 消息
+        Session, TextPart, _, _, KaosPath, ImageURLPart = _sdk()
+        
         # 创建或获取会话
-        if session_id and session_id in session_manager.sessions:
-            session = session_manager.sessions[session_id]
-        else:
+        session = session_manager.get_session(session_id) if session_id else None
+        if session is None:
             session = session_manager.create_session(work_dir)
             session_id = session.session_id
-            await websocket.send_json({
+            await send_json(websocket, {
                 "type": "session_created",
                 "session_id": session_id
             })
         
+        # 构建历史对话上下文（在添加当前用户消息之前，因此不包含当前请求）
+        context_str = "\n".join(session._ctx_deque)
+        
         # 添加用户消息
         session_manager.add_message(session_id, "user", message)
         
-        # 构建历史对话上下文（不包括最后一条用户消息，因为它是当前请求）
-        context_messages = []
-        # 取最近10条历史消息（包括用户和AI的对话）
-        for msg in session.messages[:-1][-10:]:
-            if msg["role"] == "user":
-                context_messages.append(f"用户: {msg['content']}")
-            elif msg["role"] == "assistant":
-                # 截取 AI 回复的前 500 字符，避免上下文过长
-                content = msg["content"][:500] if msg["content"] else ""
-                if len(msg["content"]) > 500:
-                    content += "..."
-                context_messages.append(f"AI: {content}")
-        
-        context_str = "\n".join(context_messages) if context_messages else ""
-        
         # 构建选中文件的上下文信息
         selected_file_context = ""
         image_parts = []  # 用于存储图片的 ContentPart
@@ -403,35 +994,21 @@ async def handle_chat(websocket: WebSocket, data: Dict):
 """
             else:
                 # 检查是否是图片文件
-                image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp'}
-                file_ext = Path(file_name).suffix.lower()
-                is_image = file_ext in image_extensions
+                file_ext = _suffix_lower(file_name)
+                is_image = file_ext in _IMAGE_EXTS
                 
                 if is_image:
                     # 读取图片并转换为 base64
                     try:
-                        path_obj = Path(file_path)
-                        if path_obj.exists() and path_obj.is_file():
-                            # 检查文件大小（限制为 5MB）
-                            file_size = path_obj.stat().st_size
-                            if file_size < 5 * 1024 * 1024:
-                                with open(path_obj, 'rb') as f:
-                                    image_data = f.read()
-                                    base64_data = base64.b64encode(image_data).decode('utf-8')
-                                    # 根据文件扩展名确定 MIME 类型
-                                    mime_type = {
-                                        '.png': 'image/png',
-                                        '.jpg': 'image/jpeg',
-                                        '.jpeg': 'image/jpeg',
-                                        '.gif': 'image/gif',
-                                        '.webp': 'image/webp',
-                                        '.bmp': 'image/bmp',
-                                    }.get(file_ext, 'image/png')
-                                    
-                                    data_url = f"data:{mime_type};base64,{base64_data}"
-                                    image_parts.append(ImageURLPart(image_url={"url": data_url}))
-                                    
-                                    selected_file_context = f"""
+                        # 根据文件扩展名确定 MIME 类型
+                        mime_type = _IMAGE_MIME.get(file_ext, 'image/png')
+                        file_data = await asyncio.to_thread(_read_selected_file, Path(file_path), mime_type)
+                        if file_data.exists and file_data.is_file:
+                            file_size = file_data.size
+                            if file_data.content is not None:
+                                image_parts.append(ImageURLPart(image_url={"url": file_data.content}))
+                                
+                                selected_file_context = f"""
 
 ### 当前选中的图片文件
 用户当前选中了图片文件: {file_path}
@@ -462,16 +1039,10 @@ async def handle_chat(websocket: WebSocket, data: Dict):
                     # 尝试读取文件内容（如果是文本文件）
                     file_content = ""
                     try:
-                        path_obj = Path(file_path)
-                        if path_obj.exists() and path_obj.is_file():
-                            # 检查文件大小（限制为 100KB）
-                            if path_obj.stat().st_size < 100 * 1024:
-                                # 尝试读取文本文件
-                                try:
-                                    with open(path_obj, 'r', encoding='utf-8', errors='ignore') as f:
-                                        file_content = f.read()
-                                except Exception as e:
-                                    file_content = f"[无法读取文件内容: {e}]"
+                        file_data = await asyncio.to_thread(_read_selected_file, Path(file_path))
+                        if file_data.exists and file_data.is_file:
+                            if file_data.content is not None:
+                                file_content = file_data.content
                             else:
                                 file_content = "[文件过大，已跳过内容读取]"
                     except Exception as e:
@@ -491,73 +1062,18 @@ async def handle_chat(websocket: WebSocket, data: Dict):
 重要提示：用户选中了这个文件，TA 的指令很可能是针对这个文件的。请根据用户的指令对这个文件进行相应的操作（如修改、分析、重构等）。
 """
 
-        # 构建增强提示
-        tools_description = """
-你可以使用以下工具来完成任务:
-
-### 文件操作
-- 读取、写入、编辑、删除文件
-- 列出目录内容
-- 搜索文件内容
-
-### 命令执行
-- 执行 shell 命令
-- 运行脚本
-
-### Git 操作
-- git status, git add, git commit, git diff
-
-### Artifacts （重要！）
-当用户需要生成代码、图表、网页等内容时，你可以使用 artifact 标签来创建可交互的预览：
-
-1. **HTML 网页**：<artifact type="html" title="页面标题">HTML代码</artifact>
-2. **React 组件**：<artifact type="react" title="组件名称">JSX代码</artifact>
-3. **SVG 图形**：<artifact type="svg" title="图表名称">SVG代码</artifact>
-4. **Python 代码**：<artifact type="python" title="脚本名称">Python代码</artifact>
-5. **Markdown**：<artifact type="markdown" title="文档标题">Markdown内容</artifact>
-
-示例：
-```
-<artifact type="react" title="计数器组件">
-export default function Counter() {
-  const [count, setCount] = React.useState(0);
-  return (
-    <div>
-      <p>Count: {count}</p>
-      <button onClick={() => setCount(count + 1)}>+1</button>
-    </div>
-  );
-}
-</artifact>
-```
-
-用户可以在侧边栏看到并交互预览你创建的内容！
-"""
-        
+        # 构建增强提示（一次 join，避免多段字符串拼接产生中间对象）
+        parts = ["工作目录: ", work_dir, "\n\n"]
         if context_str:
-            enhanced_message = f"""工作目录: {work_dir}
-
-历史对话:
-{context_str}
-
-当前用户请求: {message}
-{selected_file_context}
-
-{tools_description}
-"""
+            parts += ["历史对话:\n", context_str, "\n\n当前用户请求: ", message]
         else:
-            enhanced_message = f"""工作目录: {work_dir}
-
-用户请求: {message}
-{selected_file_context}
-
-{tools_description}
-"""
+            parts += ["用户请求: ", message]
+        parts += ["\n", selected_file_context, "\n\n", _TOOLS_DESCRIPTION, "\n"]
+        enhanced_message = "".join(parts)
         
-        full_response = ""
-        tools_used = []
+        stream = ChatStream(websocket=websocket, session_id=session_id, auto_accept=auto_accept)
         
-        await websocket.send_json({
+        await send_json(websocket, {
             "type": "thinking",
             "message": "正在思考..."
         })
@@ -567,27 +1083,19 @@ export default function Counter() {
         
         # 使用完全随机的 session_id，确保每次请求都是完全独立的
         # 避免 AI 重复之前的回复
-        import uuid
-        kaos_session_id = f"cowork-{uuid.uuid4().hex}"
+        kaos_session_id = f"cowork-{token_hex(16)}"
         
-        # 使用用户设置的模型和 API Key（如果有）
-        model = user_settings.get("model") or DEFAULT_MODEL
+        # 使用用户设置的模型和 API Key（如果有），整个请求使用同一份快照
+        # 环境变量已在设置更新时同步，这里无需再写入
+        rs = get_runtime_settings()
+        model = rs.effective_model
         
-        # 确保使用用户设置的 API Key
-        if user_settings.get("api_key"):
-            os.environ["KIMI_API_KEY"] = user_settings["api_key"]
-            # 同时确保模型名称已设置
-            model_name = user_settings.get("model") or DEFAULT_MODEL
-            os.environ["KIMI_MODEL_NAME"] = model_name
-            # 设置模型能力
-            os.environ["KIMI_MODEL_CAPABILITIES"] = "image_in,thinking"
-            print(f"[DEBUG] Using user-provided API Key: {user_settings['api_key'][:10]}... (len={len(user_settings['api_key'])})")
-            print(f"[DEBUG] Using model: {model_name}")
-            print(f"[DEBUG] Using capabilities: image_in,thinking")
-            print(f"[DEBUG] Env KIMI_API_KEY after set: {os.environ.get('KIMI_API_KEY', 'NOT SET')[:10]}...")
+        if rs.api_key:
+            log.debug("Using user-provided API Key: %.10s... (len=%d)", rs.api_key, len(rs.api_key))
+            log.debug("Using model: %s", model)
+            log.debug("Using capabilities: %s", rs.capabilities)
         else:
-            env_key = os.environ.get("KIMI_API_KEY", "")
-            print(f"[DEBUG] No user API Key, using env: {env_key[:10] if env_key else 'NOT SET'}...")
+            log.debug("No user API Key, using env: %.10s...", os.environ.get("KIMI_API_KEY") or "NOT SET")
         
         # 使用自定义 agent 文件（如果存在）
         agent_file = Path(__file__).parent / "agents" / "helix" / "agent.yaml"
@@ -602,111 +1110,29 @@ export default function Counter() {
             if image_parts:
                 # 有图片时，使用 list[ContentPart] 格式
                 prompt_input = [TextPart(text=enhanced_message)] + image_parts
-                print(f"[DEBUG] Using multimodal input with {len(image_parts)} image(s)")
+                log.debug("Using multimodal input with %d image(s)", len(image_parts))
             else:
                 # 无图片时，使用字符串格式
                 prompt_input = enhanced_message
             
+            dispatch = _dispatch_table()
             async for wire_msg in kimi_session.prompt(prompt_input):
-                if isinstance(wire_msg, TextPart):
-                    text = wire_msg.text
-                    if text:
-                        # 调试：打印每个文本片段
-                        print(f"[DEBUG] TextPart: {repr(text[:100])}...")
-                        full_response += text
-                        await websocket.send_json({
-                            "type": "stream",
-                            "content": text,
-                            "session_id": session_id
-                        })
-                
-                elif isinstance(wire_msg, ToolCall):
-                    # 调试：打印 ToolCall 的所有属性
-                    print(f"ToolCall object: {wire_msg}")
-                    print(f"ToolCall attributes: {dir(wire_msg)}")
-                    
-                    # 获取 function 对象
-                    func = getattr(wire_msg, 'function', None)
-                    print(f"Function object: {func}, type: {type(func)}")
-                    
-                    tool_name = 'unknown'
-                    tool_args = {}
-                    
-                    if func is not None:
-                        # 尝试多种方式获取 name
-                        if isinstance(func, dict):
-                            tool_name = func.get('name', 'unknown')
-                            tool_args_str = func.get('arguments', '{}')
-                        else:
-                            # 可能是 pydantic model
-                            print(f"Function attributes: {dir(func)}")
-                            # 直接访问属性
-                            if hasattr(func, 'name'):
-                                name_val = getattr(func, 'name')
-                                print(f"Got name via getattr: {name_val}")
-                                tool_name = name_val or 'unknown'
-                            # 通过 model_dump 或 dict 获取
-                            try:
-                                func_dict = func.model_dump() if hasattr(func, 'model_dump') else dict(func)
-                                print(f"Function dict: {func_dict}")
-                                tool_name = func_dict.get('name', 'unknown')
-                                tool_args_str = func_dict.get('arguments', '{}')
-                            except Exception as e:
-                                print(f"Error converting func to dict: {e}")
-                                tool_args_str = '{}'
-                        
-                        # 解析 arguments
-                        if isinstance(tool_args_str, str):
-                            try:
-                                tool_args = json.loads(tool_args_str)
-                            except json.JSONDecodeError:
-                                tool_args = {"raw": tool_args_str}
-                        else:
-                            tool_args = tool_args_str
-                    
-                    print(f"Final Tool call: {tool_name} with args: {tool_args}")
-                    
-                    tools_used.append({"tool": tool_name, "args": tool_args})
-                    await websocket.send_json({
-                        "type": "tool_call",
-                        "tool": tool_name,
-                        "args": tool_args,
-                        "session_id": session_id
-                    })
-                    
-                    # 检测文件修改操作，通知前端更新
-                    file_modifying_tools = ['write_file', 'edit_file', 'str_replace', 'str_replace_editor']
-                    if tool_name in file_modifying_tools:
-                        # 提取文件路径
-                        file_path = tool_args.get('path') or tool_args.get('file_path') or tool_args.get('file')
-                        if file_path:
-                            await websocket.send_json({
-                                "type": "file_modified",
-                                "file_path": file_path,
-                                "tool": tool_name,
-                                "session_id": session_id
-                            })
-                
-                elif isinstance(wire_msg, ApprovalRequest):
-                    if auto_accept:
-                        wire_msg.resolve("approve")
-                        await websocket.send_json({
-                            "type": "tool_approved",
-                            "auto": True
-                        })
-                    else:
-                        # 发送批准请求给前端
-                        await websocket.send_json({
-                            "type": "approval_request",
-                            "message": "需要您的批准才能继续"
-                        })
-                        # 等待前端响应（简化处理，实际应该异步等待）
-                        wire_msg.resolve("approve")
+                msg_type = type(wire_msg)
+                handler = dispatch.get(msg_type, _UNKNOWN_TYPE)
+                if handler is _UNKNOWN_TYPE:
+                    # 记住查找结果（包括无处理函数），每种类型只做一次 isinstance 判断
+                    handler = dispatch[msg_type] = _find_handler(dispatch, wire_msg)
+                if handler is not None:
+                    await handler(wire_msg, stream)
+            await flush_text(stream)
+        
+        full_response = "".join(stream.chunks)
+        tools_used = stream.tools_used
         
         # 保存助手回复
         session_manager.add_message(session_id, "assistant", full_response, tools_used)
         
-        await websocket.send_json({
+        await send_json(websocket, {
             "type": "complete",
             "content": full_response,
             "session_id": session_id,
@@ -714,13 +1140,20 @@ export default function Counter() {
         })
     
     except Exception as e:
-        print(f"处理聊天时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        await websocket.send_json({
+        log.exception("处理聊天时出错: %s", e)
+        if stream is not None:
+            cancel_text_flush(stream)
+            # 等待可能正在进行的文本发送结束，保证 error 之后不再有 stream 帧
+            async with stream.send_lock:
+                pass
+        await send_json(websocket, {
             "type": "error",
             "error": str(e)
         })
+    finally:
+        # 覆盖任务被取消等情况，不留下定时发送任务
+        if stream is not None:
+            cancel_text_flush(stream)
 
 # ============ 主程序 ============
 
@@ -733,7 +1166,8 @@ def main():
 ║   地址: http://{HOST}:{PORT}                                ║
 ║                                                          ║
 ╚══════════════════════════════════════════════════════════╝
-""")
+""", flush=True)
+    import uvicorn
     uvicorn.run(app, host=HOST, port=PORT, log_level="info")
 
 if __name__ == "__main__":